@@ -0,0 +1,329 @@
+#! /usr/bin/env python3
+
+# Times epub_counter on synthetic epubs, stage by stage and over a whole directory,
+# and writes the timings as JSON so runs from different commits can be compared.
+
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+import epub_counter
+
+WORDS = ("the of and to in a is that for it as was with be by on not he this are or his from at which "
+         "but have an they you were her she there been one all we their has would when if so no what "
+         "up can more out said who other into some could time them these two may then do first any my "
+         "now such like our over man me even most made after also did many before must through back").split()
+
+CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+
+def make_paragraph(rnd: random.Random, words: int) -> str:
+    return " ".join(rnd.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def make_chapter(rnd: random.Random, number: int, words: int, sections: int) -> str:
+    # paragraphs of about 60 words, split into sections the toc can point at
+    paragraphs = []
+    remaining = words
+    while remaining > 0:
+        length = min(remaining, rnd.randint(30, 90))
+        paragraphs.append(f"<p>{make_paragraph(rnd, length)}</p>")
+        remaining -= length
+    per_section = max(len(paragraphs) // (sections + 1), 1)
+    for section in range(sections, 0, -1):
+        at = min(section * per_section, len(paragraphs))
+        paragraphs.insert(at, f'<h2 id="s{section}">Section {section}</h2>')
+    body = "\n".join(paragraphs)
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>Chapter {number}</title></head>
+<body>
+<h1>Chapter {number}</h1>
+{body}
+</body>
+</html>
+"""
+
+
+def make_opf(chapters: int, manifest_items: int, toc: str) -> str:
+    items = [f'<item id="c{n}" href="text/chapter{n}.xhtml" media-type="application/xhtml+xml"/>'
+             for n in range(1, chapters + 1)]
+    # the rest of the manifest is images, never read by the counter
+    items += [f'<item id="img{n}" href="images/image{n}.png" media-type="image/png"/>'
+              for n in range(1, manifest_items - chapters + 1)]
+    spine_toc = ""
+    if toc == "ncx":
+        items.append('<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>')
+        spine_toc = ' toc="ncx"'
+    elif toc == "nav":
+        items.append('<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>')
+    # shuffle the manifest, which isn't in spine order in real books either
+    random.Random(chapters).shuffle(items)
+    itemrefs = "\n    ".join(f'<itemref idref="c{n}"/>' for n in range(1, chapters + 1))
+    manifest = "\n    ".join(items)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="uid">synthetic</dc:identifier>
+    <dc:title>Synthetic</dc:title>
+  </metadata>
+  <manifest>
+    {manifest}
+  </manifest>
+  <spine{spine_toc}>
+    {itemrefs}
+  </spine>
+</package>
+"""
+
+
+def make_ncx(chapters: int, sections: int) -> str:
+    points = []
+    for n in range(1, chapters + 1):
+        inner = "".join(f'<navPoint id="c{n}s{s}"><navLabel><text>Section {s}</text></navLabel>'
+                        f'<content src="text/chapter{n}.xhtml#s{s}"/></navPoint>' for s in range(1, sections + 1))
+        points.append(f'<navPoint id="c{n}"><navLabel><text>Chapter {n}</text></navLabel>'
+                      f'<content src="text/chapter{n}.xhtml"/>{inner}</navPoint>')
+    nav_map = "\n    ".join(points)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head/>
+  <docTitle><text>Synthetic</text></docTitle>
+  <navMap>
+    {nav_map}
+  </navMap>
+</ncx>
+"""
+
+
+def make_nav(chapters: int, sections: int) -> str:
+    entries = []
+    for n in range(1, chapters + 1):
+        inner = ""
+        if sections:
+            inner = "<ol>" + "".join(f'<li><a href="text/chapter{n}.xhtml#s{s}">Section {s}</a></li>'
+                                     for s in range(1, sections + 1)) + "</ol>"
+        entries.append(f'<li><a href="text/chapter{n}.xhtml">Chapter {n}</a>{inner}</li>')
+    items = "\n      ".join(entries)
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>Contents</title></head>
+<body>
+  <nav epub:type="toc">
+    <ol>
+      {items}
+    </ol>
+  </nav>
+</body>
+</html>
+"""
+
+
+def make_epub(path: str, chapters: int = 20, chapter_words: int = 5000, manifest_items: int = 0,
+              toc: str = "ncx", sections: int = 0, seed: int = 0):
+    # toc is "ncx", "nav" or "none", the last leaves the counter to fall back on the spine
+    rnd = random.Random(seed)
+    manifest_items = max(manifest_items, chapters)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as epub:
+        epub.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", CONTAINER)
+        epub.writestr("OEBPS/content.opf", make_opf(chapters, manifest_items, toc))
+        for n in range(1, chapters + 1):
+            epub.writestr(f"OEBPS/text/chapter{n}.xhtml", make_chapter(rnd, n, chapter_words, sections))
+        for n in range(1, manifest_items - chapters + 1):
+            epub.writestr(f"OEBPS/images/image{n}.png", b"\x89PNG\r\n\x1a\n" + bytes(rnd.getrandbits(8) for _ in range(256)))
+        if toc == "ncx":
+            epub.writestr("OEBPS/toc.ncx", make_ncx(chapters, sections))
+        elif toc == "nav":
+            epub.writestr("OEBPS/nav.xhtml", make_nav(chapters, sections))
+
+
+def time_stages(epub_path: str, options: epub_counter.Options) -> dict:
+    # one pass through process_epub, with each stage timed on its own
+    timings = {}
+    book = epub_counter.Book(epub_path, "synthetic", options)
+    with tempfile.TemporaryDirectory() as scratch:
+        start = time.perf_counter()
+        zip_ref = zipfile.ZipFile(epub_path, "r")
+        book.index = epub_counter.ArchiveIndex(zip_ref.infolist())
+        if options.in_memory:
+            book.archive = zip_ref
+        else:
+            book.temp_unzip = scratch
+            zip_ref.extractall(scratch)
+        timings["extraction"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        opf_file = epub_counter.get_content_opf_file(book)
+        epub_counter.read_spine(book, opf_file)
+        timings["read_spine"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        epub_counter.read_toc(book)
+        timings["toc"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        epub_counter.count_spine(book)
+        timings["count_words"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        epub_counter.allocate_count_to_tocitems(book)
+        timings["allocate"] = time.perf_counter() - start
+        zip_ref.close()
+
+        writer = epub_counter.ResultsWriter(os.path.join(scratch, "results.csv"), options)
+        start = time.perf_counter()
+        writer.write_book(os.path.basename(epub_path), book)
+        timings["output"] = time.perf_counter() - start
+        writer.close()
+    return timings
+
+
+def chapter_strings(epub_path: str) -> list:
+    # the stripped strings of every heading and paragraph in the book, as the bs4 engine collects them
+    from bs4 import BeautifulSoup
+    strings = []
+    with zipfile.ZipFile(epub_path, "r") as epub:
+        for name in sorted(epub.namelist()):
+            if name.startswith("OEBPS/text/"):
+                soup = BeautifulSoup(epub.read(name).decode("utf-8"), "html.parser")
+                for result in soup.find_all(["h", "p"]):
+                    strings.extend(result.stripped_strings)
+    return strings
+
+
+def time_tokenizers(strings: list) -> dict:
+    # counting the same strings with the old split per string and with each tokenizer
+    counters = {"split": lambda strings: sum(len(text.split(" ")) for text in strings)}
+    for name, tokenizer in epub_counter.TOKENIZERS.items():
+        counters[name] = tokenizer.count
+    timings = {}
+    for name, counter in counters.items():
+        start = time.perf_counter()
+        words = counter(strings)
+        timings[name] = (time.perf_counter() - start, words)
+    return timings
+
+
+def time_directory(folder: str, counter_args: list) -> float:
+    # the whole command line run, startup included
+    command = [sys.executable, os.path.abspath(epub_counter.__file__), folder, "--no-cache"] + counter_args
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def summarise(runs: list) -> dict:
+    return {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+        "runs": runs,
+    }
+
+
+def git_commit() -> str:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="benchmark",
+                                     description="Time epub_counter on synthetic epubs and write the results as JSON.")
+    parser.add_argument("--chapters", type=int, default=20, help="spine documents per book (default 20)")
+    parser.add_argument("--chapter-words", type=int, default=5000, help="words in each chapter (default 5000)")
+    parser.add_argument("--manifest-items", type=int, default=0,
+                        help="total manifest entries, padded out with images (default one per chapter)")
+    parser.add_argument("--toc", choices=("ncx", "nav", "none"), default="ncx",
+                        help="kind of table of contents, none falls back on the spine (default ncx)")
+    parser.add_argument("--sections", type=int, default=0,
+                        help="anchored sections per chapter, each with a nested toc entry (default 0)")
+    parser.add_argument("--books", type=int, default=10, help="books in the directory run (default 10)")
+    parser.add_argument("--repeat", type=int, default=5, help="times to repeat each measurement (default 5)")
+    parser.add_argument("-p", "--parser", choices=sorted(epub_counter.WORD_COUNTERS), default="bs4")
+    parser.add_argument("--tokenizer", choices=sorted(epub_counter.TOKENIZERS), default="compat")
+    parser.add_argument("-m", "--in-memory", action="store_true", help="time the in-memory mode")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="jobs for the directory run (default 1)")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N",
+                        help="books read ahead in the directory run (default 0)")
+    parser.add_argument("-o", "--output", help="write the JSON here rather than to standard output")
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args(sys.argv[1:])
+    options = epub_counter.Options()
+    options.in_memory = args.in_memory
+    options.parser = args.parser
+    options.tokenizer = args.tokenizer
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "stages": {},
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        for n in range(args.books):
+            make_epub(os.path.join(folder, f"book{n}.epub"), chapters=args.chapters,
+                      chapter_words=args.chapter_words, manifest_items=args.manifest_items,
+                      toc=args.toc, sections=args.sections, seed=n)
+        report["book_bytes"] = os.path.getsize(os.path.join(folder, "book0.epub"))
+
+        stage_runs = {}
+        for _ in range(args.repeat):
+            for stage, seconds in time_stages(os.path.join(folder, "book0.epub"), options).items():
+                stage_runs.setdefault(stage, []).append(seconds)
+        for stage, runs in stage_runs.items():
+            report["stages"][stage] = summarise(runs)
+
+        strings = chapter_strings(os.path.join(folder, "book0.epub"))
+        characters = sum(len(text) for text in strings)
+        tokenizer_runs = {}
+        words = {}
+        for _ in range(args.repeat):
+            for name, (seconds, count) in time_tokenizers(strings).items():
+                tokenizer_runs.setdefault(name, []).append(seconds)
+                words[name] = count
+        report["tokenizers"] = {}
+        for name, runs in tokenizer_runs.items():
+            report["tokenizers"][name] = summarise(runs)
+            report["tokenizers"][name]["words"] = words[name]
+            report["tokenizers"][name]["characters_per_second"] = characters / min(runs)
+
+        counter_args = ["--parser", args.parser, "--tokenizer", args.tokenizer, "--jobs", str(args.jobs)]
+        if args.in_memory:
+            counter_args.append("--in-memory")
+        if args.prefetch:
+            counter_args += ["--prefetch", str(args.prefetch)]
+        report["directory"] = summarise([time_directory(folder, counter_args) for _ in range(args.repeat)])
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as outfile:
+            outfile.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
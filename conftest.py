@@ -0,0 +1,2 @@
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: takes a minute or so, deselect with -m 'not slow'")
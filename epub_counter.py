@@ -1,66 +1,562 @@
 #! /usr/bin/env python3
 
 import zipfile
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import codecs
+import csv
+import functools
+import hashlib
+import heapq
+import html.entities
+import html.parser
+import io
+import json
+import multiprocessing
 import sys
 import os
+import posixpath
 import shutil
+import sqlite3
+import tempfile
+import time
 import urllib.parse
 import regex
-from bs4 import BeautifulSoup
 import xml.etree.ElementTree as ET
+try:
+    import resource  # not on Windows, where peak memory isn't reported
+except ImportError:
+    resource = None
 
-temp_unzip = ""
-tocitems = []
-spineitems = []
-accumulator = ""
-make_csv = True
+CACHE_FILE = ".epub_counter_cache.sqlite"
+COUNTER_VERSION = 1  # bump whenever a change to the counting rules makes cached counts stale
+CACHE_SCHEMA = 2  # bump whenever the cache's table changes, older caches are then emptied
 
 # there may be a one to many relationship between TocItem and SpineItem
 
 class TocItem():
-    title = ""
-    href = ""
-    order = 0
-    word_count = 0
+    __slots__ = ("title", "href", "fragment", "level", "order", "word_count")
+
+    def __init__(self):
+        self.title = ""
+        self.href = ""
+        self.fragment = ""  # the anchor within href the entry starts at, if any
+        self.level = 1  # how deeply the entry is nested in the table of contents
+        self.order = 0
+        self.word_count = 0
 
 
 class SpineItem():
-    href = ""
-    spine_id = ""
-    word_count = 0
+    __slots__ = ("href", "spine_id", "word_count", "segments")
+
+    def __init__(self):
+        self.href = ""
+        self.spine_id = ""
+        self.word_count = 0
+        self.segments: dict = None  # words from the start of the file and from each anchor on, in document order
+
+
+class BookResult():
+    # what count_epub hands back: the book's table of contents entries with their word counts
+    __slots__ = ("name", "entries", "words", "error")
+
+    def __init__(self, name: str, entries: tuple = (), words: int = 0, error: str = None):
+        self.name = name
+        self.entries = entries  # TocItems in table of contents order
+        self.words = words  # in the whole spine, including anything before the first entry
+        self.error = error  # why the book couldn't be counted, only ever set by count_many
+
+    def __repr__(self):
+        if self.error:
+            return f"BookResult({self.name!r}, error={self.error!r})"
+        return f"BookResult({self.name!r}, {len(self.entries)} entries, {self.words} words)"
+
+
+class Options():
+    # settings from the command line, handed to every worker
+    make_csv = True
+    in_memory = False
+    jobs = 1
+    parser = "bs4"
+    buffer_size = 65536  # characters of a document the stream parser reads at a time
+    cache_path = ""  # empty when --no-cache
+    cache_size = 200000
+    profile_dir = ""  # where to save cProfile data for each book, empty unless --profile
+    prefetch = 0  # books read ahead by reader threads
+    verbose = True  # say which book is being counted
+    tokenizer = "compat"  # a name from TOKENIZERS, or a Tokenizer with script rules of your own
+    # start the process's peak memory afresh for each book, so its peak is its own. That
+    # resets the peak for the whole process, threads and all, so only the command line does it
+    reset_peak_rss = False
+    fingerprint = False  # note each book's size, mtime and content hash, which --shard needs for merge
+
+
+class ResultCache():
+    # word counts of spine documents we have already seen, keyed on the CRC32 and size
+    # the zip keeps for every member, so an unchanged chapter (in this book or any other)
+    # is never decompressed or parsed again. Entries unused for longest are evicted first.
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")  # lets several workers share it
+        with self.connection:
+            if self.connection.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA:
+                self.connection.execute("DROP TABLE IF EXISTS chapters")
+                self.connection.execute(f"PRAGMA user_version={CACHE_SCHEMA}")
+            # the same file is counted differently depending on which anchors the TOC points at
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS chapters (
+                crc INTEGER, size INTEGER, parser TEXT, anchors TEXT, segments TEXT, last_used REAL,
+                PRIMARY KEY (crc, size, parser, anchors))""")
+        self.hits = 0
+        self.misses = 0
+        self.used = []  # keys of the hits, whose last_used is only written at close()
+
+    def lookup(self, crc: int, size: int, parser: str, anchors: str) -> dict:
+        row = self.connection.execute("""SELECT segments FROM chapters
+            WHERE crc=? AND size=? AND parser=? AND anchors=?""", (crc, size, parser, anchors)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.append((time.time(), crc, size, parser, anchors))
+        return dict(json.loads(row[0]))
+
+    # every write is committed straight away, as SQLite lets only one connection write at a time
+    # and a transaction left open would hold the other workers up until this book was finished
+    def holds(self, crc: int, size: int, parser: str) -> bool:
+        # whether a file has been counted at all, with any anchors, without counting it as a hit
+        row = self.connection.execute("SELECT 1 FROM chapters WHERE crc=? AND size=? AND parser=? LIMIT 1",
+                                      (crc, size, parser)).fetchone()
+        return row is not None
+
+    def store(self, crc: int, size: int, parser: str, anchors: str, segments: dict):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO chapters VALUES (?, ?, ?, ?, ?, ?)",
+                                    (crc, size, parser, anchors, json.dumps(list(segments.items())), time.time()))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute("DELETE FROM chapters")
+
+    def evict(self, max_entries: int) -> int:
+        with self.connection:
+            cursor = self.connection.execute("""DELETE FROM chapters WHERE rowid NOT IN
+                (SELECT rowid FROM chapters ORDER BY last_used DESC LIMIT ?)""", (max_entries,))
+        return cursor.rowcount
+
+    def close(self):
+        if self.used:
+            # the hits' last_used in one short transaction, rather than one for every hit
+            with self.connection:
+                self.connection.executemany("""UPDATE chapters SET last_used=?
+                    WHERE crc=? AND size=? AND parser=? AND anchors=?""", self.used)
+            self.used = []
+        self.connection.close()
+
+
+class ArchiveIndex():
+    # built in one pass over the zip's list of members, so finding a file in the book
+    # never has to walk the unpacked folder. Lookups hand back zip member names.
+    def __init__(self, infolist: list = ()):
+        self.members = {}  # member name -> ZipInfo, which has the CRC32 and size of each
+        self.by_extension = {}
+        self.by_basename = {}
+        for info in infolist:
+            if info.is_dir():
+                continue
+            self.members[info.filename] = info
+            basename = posixpath.basename(info.filename).lower()
+            _, extension = posixpath.splitext(basename)
+            self.by_extension.setdefault(extension, []).append(info.filename)
+            self.by_basename.setdefault(basename, []).append(info.filename)
+
+    def find_extension(self, extension: str) -> str:
+        names = self.by_extension.get(extension.lower())
+        return names[0] if names else None
+
+    def find_basename(self, basename: str) -> str:
+        names = self.by_basename.get(basename.lower())
+        return names[0] if names else None
+
+
+class PrefetchedArchive():
+    # an epub read into memory by a reader thread, so counting it never waits on the disk,
+    # with the spine documents we'll have to count already decompressed. Those the cache
+    # holds are left alone, as are big ones, which are streamed out of the compressed bytes
+    # as they're counted to keep memory bounded. Stands in for the ZipFile when reading
+    # members straight from the zip.
+    LARGEST_MEMBER = 8 * 1024 * 1024
+
+    def __init__(self, path: str, options: Options):
+        with open(path, "rb") as epub:
+            self.zip = zipfile.ZipFile(io.BytesIO(epub.read()), 'r')
+        self.contents = {}
+        cache = ResultCache(options.cache_path) if options.cache_path else None
+        try:
+            for name in self.spine_members(path, options):
+                info = self.zip.getinfo(name)
+                if info.file_size > self.LARGEST_MEMBER:
+                    continue
+                if cache and cache.holds(info.CRC, info.file_size, cache_parser(options)):
+                    continue
+                self.contents[name] = self.zip.read(info)
+        finally:
+            if cache:
+                cache.close()
+
+    def spine_members(self, path: str, options: Options) -> list:
+        # a look at the OPF on the side. If it can't be read, nothing is decompressed ahead
+        # and counting the book finds the problem and reports it
+        book = Book(path, "", options)
+        book.index = ArchiveIndex(self.zip.infolist())
+        book.archive = self.zip
+        try:
+            opf_file = get_content_opf_file(book)
+            if opf_file:
+                read_spine(book, opf_file)
+        except (ET.ParseError, OSError, KeyError, ValueError, RuntimeError):
+            return []
+        return [member_name(book, spineitem.href) for spineitem in book.spineitems
+                if file_exists(book, spineitem.href)]
+
+    def infolist(self) -> list:
+        return self.zip.infolist()
+
+    def open(self, name: str):
+        if name in self.contents:
+            return io.BytesIO(self.contents[name])
+        return self.zip.open(name)
+
+    def close(self):
+        self.zip.close()
+
+
+def prefetch_archives(epub_folder: str, epub_files: list, depth: int, options: Options):
+    # yields (epub file, PrefetchedArchive) in order, while up to depth books
+    # further on are being read by reader threads. Depth caps the memory used.
+    files = iter(epub_files)
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=depth) as readers:
+        for afile in files:
+            pending.append((afile, readers.submit(PrefetchedArchive, os.path.join(epub_folder, afile), options)))
+            if len(pending) >= depth:
+                break
+        while pending:
+            afile, future = pending.popleft()
+            archive = future.result()
+            for next_file in files:
+                pending.append((next_file, readers.submit(PrefetchedArchive, os.path.join(epub_folder, next_file), options)))
+                break
+            yield afile, archive
+
+
+class Book():
+    # everything we know about the epub currently being processed, so that
+    # several books can be counted side by side without sharing any state
+    def __init__(self, path: str, name: str, options: Options):
+        self.path = path
+        self.name = name
+        self.options = options
+        self.temp_unzip = ""  # scratch folder the epub is unpacked into
+        self.archive: zipfile.ZipFile = None  # open epub when reading members straight from the zip
+        self.index = ArchiveIndex()
+        self.toc_ncx = None  # paths of the tables of contents the manifest points to, if any
+        self.toc_nav = None
+        self.cache: ResultCache = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # what it cost us, for --stats-json
+        self.stage_times = {}  # stage -> [wall seconds, cpu seconds]
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.bytes_decompressed = 0
+        self.peak_rss = None
+        self.peak_rss_scope = None  # "book" when peak_rss is this book's own, "process" when it's the process's
+        self.rss_growth = None  # how far the book took the peak above where it stood when the book began
+        self.size = None  # of the epub file, only when fingerprinting
+        self.mtime = None
+        self.sha256 = None
+        self.tocitems = []
+        self.spineitems = []
+
+
+class ResultsWriter():
+    # writes each book's rows as soon as it is finished, so memory use stays flat and a
+    # crash loses at most the book in hand. After every book the size of the output so far
+    # is noted in a checkpoint file, which --resume uses to carry on where we left off.
+    def __init__(self, fpath: str, options: Options, resume: bool = False):
+        self.make_csv = options.make_csv
+        self.checkpoint_path = fpath + ".progress"
+        self.done = set()  # epub files already in the output
+        offset = None
+        if resume:
+            offset = self.read_checkpoint(fpath)
+        if offset is None:
+            self.done = set()
+            self.outfile = open(fpath, 'w', encoding='utf-8', newline='')
+            self.checkpoint = open(self.checkpoint_path, 'w', encoding='utf-8')
+        else:
+            self.outfile = open(fpath, 'r+', encoding='utf-8', newline='')
+            self.outfile.seek(offset)
+            self.outfile.truncate()  # drop anything written for a book that didn't finish
+            self.checkpoint = open(self.checkpoint_path, 'a', encoding='utf-8')
+        self.csv_writer = csv.writer(self.outfile, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n")
+        if offset is None:
+            self.write_header()
+            self.outfile.flush()
+
+    def write_header(self):
+        if self.make_csv:
+            # write field names for CSV at top of output file
+            self.csv_writer.writerow(["Book", "Title", "Order", "Words"])
+
+    def read_checkpoint(self, fpath: str) -> int:
+        # returns the length of the output covering every finished book, or None to start afresh
+        if not os.path.exists(fpath) or not os.path.exists(self.checkpoint_path):
+            return None
+        size = os.path.getsize(fpath)
+        offset = None
+        with open(self.checkpoint_path, "r", encoding="utf-8") as checkpoint:
+            for line in checkpoint:
+                bits = line.rstrip("\n").split("\t", 1)
+                if len(bits) != 2 or not bits[0].isdigit() or int(bits[0]) > size:
+                    break  # a line cut short by the crash, or output that never reached the disk
+                offset = int(bits[0])
+                self.done.add(bits[1])
+        return offset
+
+    def write_book(self, afile: str, book: Book):
+        self.write_rows(afile, book)
+        self.outfile.flush()
+        self.checkpoint.write(f"{self.outfile.tell()}\t{afile}\n")
+        self.checkpoint.flush()
+        self.done.add(afile)
+
+    def write_rows(self, afile: str, book: Book):
+        if self.make_csv:
+            for tocitem in book.tocitems:
+                self.csv_writer.writerow([book.name, tocitem.title, tocitem.order, tocitem.word_count])
+        else:
+            self.outfile.write(f"\n\nprocessing {afile}\n")
+            for tocitem in book.tocitems:
+                indent = "  " * (tocitem.level - 1)
+                self.outfile.write(f"{indent}{tocitem.title}: {tocitem.word_count} words\n")
+
+    def close(self, finished: bool = True):
+        self.outfile.close()
+        self.checkpoint.close()
+        if finished:
+            os.remove(self.checkpoint_path)  # nothing left to resume
+
+
+class ShardWriter(ResultsWriter):
+    # the partial results of one --shard run, a line of JSON for each book with everything
+    # merge needs to write it out as a whole run would, in either format, and to tell whether
+    # the epub has changed since. Resumes just as ResultsWriter does
+    def __init__(self, fpath: str, options: Options, resume: bool = False):
+        # how the books were counted, merge won't mix shards counted differently
+        self.settings = {"parser": options.parser, "tokenizer": get_tokenizer(options).name, "counter": COUNTER_VERSION}
+        super().__init__(fpath, options, resume)
+
+    def write_header(self):
+        pass
+
+    def write_rows(self, afile: str, book: Book):
+        entry = {
+            "file": afile,
+            "size": book.size,
+            "mtime": book.mtime,
+            "sha256": book.sha256,
+            "name": book.name,
+            **self.settings,
+            "entries": [[tocitem.title, tocitem.order, tocitem.level, tocitem.word_count] for tocitem in book.tocitems],
+        }
+        self.outfile.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+class StatsWriter():
+    # timings and sizes for each book, written as soon as it is finished so they don't
+    # pile up in memory over a long run, followed by a summary of the whole run
+    def __init__(self, fpath: str):
+        self.outfile = open(fpath, 'w', encoding='utf-8')
+        self.outfile.write('{"books": [')
+        self.count = 0
+
+    def write_book(self, afile: str, book: Book):
+        words = sum(spineitem.word_count for spineitem in book.spineitems)
+        entry = {
+            "file": afile,
+            "wall_time": book.wall_time,
+            "cpu_time": book.cpu_time,
+            "stages": {stage: {"wall_time": wall, "cpu_time": cpu} for stage, (wall, cpu) in book.stage_times.items()},
+            "bytes_decompressed": book.bytes_decompressed,
+            "spine_documents": len(book.spineitems),
+            "words": words,
+            "words_per_second": words / book.wall_time if book.wall_time else None,
+            "peak_rss": book.peak_rss,
+            "peak_rss_scope": book.peak_rss_scope,
+            "rss_growth": book.rss_growth,
+            "cache_hits": book.cache_hits,
+            "cache_misses": book.cache_misses,
+        }
+        separator = "," if self.count else ""
+        self.outfile.write(f"{separator}\n  {json.dumps(entry)}")
+        self.outfile.flush()
+        self.count += 1
+
+    def close(self, summary: dict):
+        self.outfile.write(f"\n],\n\"run\": {json.dumps(summary, indent=2)}}}\n")
+        self.outfile.close()
+
+
+@contextlib.contextmanager
+def timed(book: Book, stage: str):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        times = book.stage_times.setdefault(stage, [0.0, 0.0])
+        times[0] += time.perf_counter() - wall
+        times[1] += time.process_time() - cpu
+
+
+def file_fingerprint(path: str) -> tuple:
+    # size, mtime and sha256 of a file, read a piece at a time
+    stat = os.stat(path)
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(chunk)
+    return stat.st_size, stat.st_mtime, digest.hexdigest()
+
+
+def shard_of(afile: str, shards: int) -> int:
+    # which of the shards (counting from 1) a file belongs to. Only the name is hashed, so
+    # every node agrees without talking to the others, and a book stays in the same shard
+    digest = hashlib.sha1(afile.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shards + 1
+
+
+def shard_suffix(shard: tuple) -> str:
+    index, shards = shard
+    return f".shard-{index}-of-{shards}"
+
+
+def reset_peak_rss() -> bool:
+    # Linux lets us start the high-water mark afresh, so peak_rss() covers just the book in hand.
+    # Elsewhere we're stuck with the peak since the process started
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss() -> int:
+    # in bytes, the most memory this process has used since it started or reset_peak_rss()
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # macOS counts bytes, Linux kilobytes
+
+
+def href_to_filepath(book: Book, href: str) -> str:
+    temp = urllib.parse.unquote(href)  # get rid of %20 etc
+    if book.archive:
+        return temp  # zip member names always use forward slashes
+    bits = temp.split('/')
+    path = ""
+    for bit in bits:
+        path = os.path.join(path, bit)
+    return path
 
 
-def clear_output():
-    global accumulator
-    accumulator = ""
+def join_path(book: Book, head: str, tail: str) -> str:
+    if book.archive:
+        return posixpath.normpath(posixpath.join(head, tail))
+    return os.path.normpath(os.path.join(head, tail))
 
 
-def collect_output(to_write:str):
-    global accumulator
-    accumulator += to_write + "\n"
+def split_path(book: Book, path: str):
+    if book.archive:
+        return posixpath.split(path)
+    return os.path.split(path)
 
 
-def write_output(fpath: str):
-    with open(fpath, 'w', encoding='utf-8') as outfile:
-        outfile.write(accumulator)
+def resolve_href(book: Book, head: str, href: str) -> tuple:
+    # an href in a file in folder head, as the path of the file it points to and the #fragment
+    path, _, fragment = href.partition("#")
+    return join_path(book, head, href_to_filepath(book, path)), urllib.parse.unquote(fragment)
 
 
-def href_to_filepath(href: str) -> str:
-    temp = urllib.parse.unquote(href)  # get rid of %20 etc
-    bits = temp.split('/')
-    path = ""
-    for bit in bits:
-        path = os.path.join(path, bit)
-    return path
+def member_name(book: Book, path: str) -> str:
+    if book.archive:
+        return path
+    return os.path.relpath(path, book.temp_unzip).replace(os.sep, "/")
+
 
+def member_path(book: Book, name: str) -> str:
+    # where to find a zip member, whether we unpacked the book or not
+    if name is None or book.archive:
+        return name
+    return os.path.join(book.temp_unzip, *name.split("/"))
 
-def process_toc_ncx(tocfile:str):
+
+def file_exists(book: Book, path: str) -> bool:
+    return member_name(book, path) in book.index.members
+
+
+def member_info(book: Book, path: str) -> zipfile.ZipInfo:
+    return book.index.members.get(member_name(book, path))
+
+
+def open_binary(book: Book, path: str):
+    # only the member asked for is decompressed, images, fonts etc are never touched
+    if book.archive:
+        book.bytes_decompressed += book.index.members[path].file_size
+        return book.archive.open(path)
+    return open(path, "rb")
+
+
+def declared_encoding(head: bytes) -> str:
+    # the encoding a document says it is in, from its byte order mark, XML declaration
+    # or <meta> charset, in that order. XHTML without any of these is UTF-8
+    for bom, encoding in ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")):
+        if head.startswith(bom):
+            return encoding
+    if head.startswith(b"<\x00"):
+        return "utf-16-le"
+    if head.startswith(b"\x00<"):
+        return "utf-16-be"
+    found = regex.match(rb"""\s*<\?xml[^>]*?encoding\s*=\s*["']([-\w.:]+)""", head) or \
+        regex.search(rb"""<meta[^>]*?charset\s*=\s*["']?([-\w.:]+)""", head, regex.IGNORECASE)
+    if found:
+        try:
+            return codecs.lookup(found.group(1).decode("ascii")).name
+        except LookupError:
+            pass  # a name Python doesn't know, so we're no worse off guessing UTF-8
+    return "utf-8"
+
+
+def open_text(book: Book, path: str, encoding: str = None):
+    binary = open_binary(book, path)
+    if not isinstance(binary, io.BufferedReader):
+        binary = io.BufferedReader(binary)  # a zip member's own peek gives back no more than 512 bytes
+    if encoding is None:
+        encoding = declared_encoding(binary.peek(1024)[:1024])
+    return io.TextIOWrapper(binary, encoding=encoding)
+
+
+def process_toc_ncx(book: Book, tocfile:str):
     # this is an xml file, a bit messy to parse
-    global tocitems
-    toc_count = 0
-    tree = ET.parse(tocfile)
+    with open_binary(book, tocfile) as tf:
+        tree = ET.parse(tf)
     root = tree.getroot()
-    tocitems = []
+    book.tocitems = []
     navMap = None
 
     for child in root:
@@ -68,235 +564,635 @@ def process_toc_ncx(tocfile:str):
             navMap = child
             continue
 
-    if not navMap:
+    if navMap is None:
         print("Error, no navMap found")
         return
 
-    for navPoint in navMap:
+    head, _ = split_path(book, tocfile)
+    add_navpoints(book, navMap, head, 1)
+
+
+def add_navpoints(book: Book, parent, head: str, level: int):
+    # navPoints nest, so every one is followed by the ones inside it
+    for navPoint in parent:
+        if "navPoint" not in navPoint.tag:
+            continue
         tocitem = TocItem()
+        tocitem.level = level
         for child in navPoint:
             if "navLabel" in child.tag:
                 tocitem.title = "".join(child.itertext()).strip()
             if "content" in child.tag:
-                tocitem.href = child.get("src","-")
-                if "#" in tocitem.href:
-                    bits = tocitem.href.split("#")
-                    tocitem.href = bits[0]
-                tocitem.href = href_to_filepath(tocitem.href)
-        toc_count += 1
-        tocitem.order = toc_count
-        tocitems.append(tocitem)
+                tocitem.href, tocitem.fragment = resolve_href(book, head, child.get("src","-"))
+        tocitem.order = len(book.tocitems) + 1
+        book.tocitems.append(tocitem)
+        add_navpoints(book, navPoint, head, level + 1)
+
+
+class TocLinkParser(html.parser.HTMLParser):
+    # collects the links in an EPUB3 nav document, or an older toc.html, with how deeply
+    # each is nested in lists. If there is a <nav epub:type="toc"> only its links are wanted.
+    LIST_TAGS = ("ol", "ul")
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links = []  # (level, href, title) of every link
+        self.toc_links = []  # the same, for the links inside the toc nav
+        self.found_toc_nav = False
+        self.in_toc_nav = False
+        self.nav_depth = 0
+        self.list_depth = 0
+        self.href = None  # of the link we're in
+        self.title = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in self.LIST_TAGS:
+            self.list_depth += 1
+        elif tag == "nav":
+            self.nav_depth += 1
+            if not self.found_toc_nav and "toc" in (attrs.get("epub:type") or "").split():
+                self.found_toc_nav = True
+                self.in_toc_nav = True
+                self.toc_nav_depth = self.nav_depth
+        elif tag == "a" and attrs.get("href"):
+            self.href = attrs["href"]
+            self.title = []
+
+    def handle_endtag(self, tag):
+        if tag in self.LIST_TAGS:
+            self.list_depth = max(self.list_depth - 1, 0)
+        elif tag == "nav":
+            if self.in_toc_nav and self.nav_depth == self.toc_nav_depth:
+                self.in_toc_nav = False
+            self.nav_depth = max(self.nav_depth - 1, 0)
+        elif tag == "a" and self.href is not None:
+            link = (max(self.list_depth, 1), self.href, " ".join("".join(self.title).split()))
+            self.links.append(link)
+            if self.in_toc_nav:
+                self.toc_links.append(link)
+            self.href = None
+
+    def handle_data(self, data):
+        if self.href is not None:
+            self.title.append(data)
+
+
+def process_toc_html(book: Book, tocfile:str):
+    parser = TocLinkParser()
+    with open_text(book, tocfile) as tf:
+        parser.feed(tf.read())
+    parser.close()
+
+    head, _ = split_path(book, tocfile)
+    links = parser.toc_links if parser.found_toc_nav else parser.links
+    for level, href, title in links:
+        tocitem = TocItem()
+        tocitem.title = title
+        tocitem.level = level
+        tocitem.href, tocitem.fragment = resolve_href(book, head, href)
+        tocitem.order = len(book.tocitems) + 1
+        book.tocitems.append(tocitem)
 
 
-def process_toc_html(tocfile:str):
-    global tocitems
-    toc_count = 0
-    with open(tocfile, "r") as tf:
-        lines = tf.readlines()
-        pattern = r'<a href="(.*?)">(.*?)</a>'
-        for line in lines:
-            match = regex.search(pattern, line)
-            if match:
-                tocitem = TocItem()
-                tocitem.title = match.group(2).strip()
-                tocitem.href = match.group(1)
-                if "#" in tocitem.href:
-                    bits = tocitem.href.split("#")
-                    tocitem.href = bits[0]
-                tocitem.href = href_to_filepath(tocitem.href)
-                toc_count += 1
-                tocitem.order = toc_count
-                tocitems.append(tocitem)
-        tf.close()
-
-
-def process_content_opf(opffile:str):
+def process_content_opf(book: Book, opffile:str):
     # this should only be called if we can't find toc
-    global tocitems
     toc_count = 0
-    # read_spine(opffile)  # spine should already have been read
-    for spineitem in spineitems:
+    # read_spine(book, opffile)  # spine should already have been read
+    for spineitem in book.spineitems:
         tocitem = TocItem()
         temp = regex.sub(r'\.x?html', '', spineitem.href)
         tocitem.title = regex.sub(r'[\-_]', ' ', temp).strip()
         tocitem.href = spineitem.href
-        tocitem.href = href_to_filepath(tocitem.href)
+        tocitem.href = href_to_filepath(book, tocitem.href)
         toc_count += 1
         tocitem.order = toc_count
-        tocitems.append(tocitem)
-
-
-def count_words(html_file) -> int:
-    total_words = 0
-    if os.path.exists(html_file):
-        with open(html_file,"r") as hf:
-            html = hf.read()
-            hf.close()
-
-        # we use the "BeautifulSoup" package which is an easy way to parse a HTML file    
-        soup = BeautifulSoup(html, "html.parser")
-        resultSet = soup.find_all(["h","p"])  # find all headings and paragraphs
-        for result in resultSet:
-            strings = result.stripped_strings
-            for text in strings:
-                if text:
-                    bits = text.split(" ")
-                    total_words += len(bits)
-    return total_words
-
-
-def read_spine(opffile:str):
-    global spineitems
-    spineitems = []
-    manifest_items = []
-    with open(opffile, "r") as opf:
-        lines = opf.readlines()
-        # first, have to read the manifest, which has the correct URLs
-        # manifest is not in same order as the spine! Need it in spine order
-        item_pattern = r'<item '
-        href_pattern = r'href="(.*?)"'
-        id_pattern = r'id="(.*?)"'
-        for line in lines:
-            match_item = regex.search(item_pattern, line)
-            if match_item:
-                match_href = regex.search(href_pattern, line)
-                if match_href:
-                    manifest_item = SpineItem()
-                    manifest_item.href = match_href.group(1)
-                    match_id = regex.search(id_pattern, line)
-                    if match_id:
-                        manifest_item.spine_id = match_id.group(1)
-
-                    manifest_items.append(manifest_item)
-        href_pattern = r'idref="(.*?)"'
-        for line in lines:
-            match_href = regex.search(href_pattern, line)
-            if match_href:
-                spineitem = SpineItem()
-                spineitem.spine_id = match_href.group(1)
-                spineitems.append(spineitem)
-
-        for spineitem in spineitems:
-            for manifest_item in manifest_items:
-                if manifest_item.spine_id == spineitem.spine_id:
-                    spineitem.href = manifest_item.href
-                    if "#" in spineitem.href:
-                        bits = spineitem.href.split("#")
-                        spineitem.href = bits[0]
-                    spineitem.href = href_to_filepath(spineitem.href)
-                    break
-            if not spineitem.href:
-                spineitems.remove(spineitem)
-                    
-        opf.close()
-
-        head, _ = os.path.split(opffile)
-        for spineitem in spineitems:
-            if not spineitem.href:
-                print("Error! empty href")
-                spineitem.word_count = -1
-            else:
-                spineitem.word_count = count_words(os.path.join(head,spineitem.href))
-
-
-def recursive_find(wanted:str, root_path: str) -> str:
-    return_val = None
-    for root, dirs, files in os.walk(root_path, topdown=True):
-        for afile in files:
-            if wanted in afile:
-                return os.path.join(root, afile)
-        for folder in dirs:
-            return_val = recursive_find(wanted=wanted, root_path=os.path.join(root, folder))
-            if return_val:
-                return return_val
-    return return_val
-
+        book.tocitems.append(tocitem)
+
+
+class SplitCounter():
+    # len(text.strip().split(" ")) for a string that arrives in pieces, worked out without
+    # keeping the pieces, so one enormous paragraph takes no more memory than a short one
+    def __init__(self):
+        self.started = False  # seen anything but whitespace yet
+        self.spaces = 0  # spaces between the words so far
+        self.pending = 0  # spaces after the last word so far, which count if another word follows
+
+    def feed(self, text: str):
+        if not self.started:
+            text = text.lstrip()
+            if not text:
+                return
+            self.started = True
+        body = text.rstrip()
+        if body:
+            self.spaces += self.pending + body.count(" ")
+            self.pending = text.count(" ", len(body))
+        else:
+            self.pending += text.count(" ")
+
+    def words(self) -> int:
+        return self.spaces + 1 if self.started else 0
+
+
+class ScriptRule():
+    # how to count a script that is written without spaces between words. chars is the inside
+    # of a regex character class, such as r"\p{Han}". Each character is a word by default.
+    # Otherwise a whole run of the script is one word, unless segment(run) says how many it holds,
+    # which is where a dictionary based segmenter can be plugged in.
+    __slots__ = ("name", "chars", "per_character", "segment")
+
+    def __init__(self, name: str, chars: str, per_character: bool = True, segment=None):
+        self.name = name
+        self.chars = chars
+        self.per_character = per_character
+        self.segment = segment
+
+
+class Tokenizer():
+    # counts words with one precompiled pattern over all the text it is given: a word is a run
+    # of letters, marks and digits, which apostrophes and hyphens (and in numbers . and ,) join
+    # up, and the script rules say what counts as a word in scripts without spaces. Whitespace of
+    # any kind, non-breaking spaces included, only ever separates words.
+    JOINERS = r"'\u2019\-\u2010"
+
+    def __init__(self, name: str, rules: list = ()):
+        self.name = name
+        self.rules = tuple(rules)
+        alternatives = []
+        for rule in self.rules:
+            repeat = "" if rule.per_character else "+"
+            alternatives.append(rf"(?P<{rule.name}>(?:[{rule.chars}]\p{{M}}*){repeat})")
+        letters = r"[\p{L}\p{M}\p{N}]"
+        if self.rules:
+            letters = f"[{letters}--[{''.join(rule.chars for rule in self.rules)}]]"
+        alternatives.append(rf"{letters}+(?:(?:[{self.JOINERS}]|(?<=\p{{N}})[.,](?=\p{{N}})){letters}+)*")
+        self.pattern = regex.compile("|".join(alternatives), regex.V1)
+        # the last character nothing can carry on past, found by searching from the end
+        self.boundary = regex.compile(rf"[^\p{{L}}\p{{M}}\p{{N}}{self.JOINERS}.,]", regex.V1 | regex.REVERSE)
+        self.segmenters = {rule.name: rule.segment for rule in self.rules if rule.segment}
+
+    def count(self, strings: list) -> int:
+        # the strings are counted together, they can't run into one another across the newlines
+        return self.count_text("\n".join(strings))
+
+    def count_text(self, text: str) -> int:
+        if not self.segmenters:
+            return len(self.pattern.findall(text))
+        words = 0
+        for match in self.pattern.finditer(text):
+            segment = self.segmenters.get(match.lastgroup)
+            words += segment(match.group()) if segment else 1
+        return words
+
+    def string_counter(self, buffer_size: int) -> "TokenCounter":
+        return TokenCounter(self, buffer_size)
+
+
+class CompatTokenizer():
+    # the original rule, one word more than there are spaces in each stripped string. Runs of
+    # spaces count empty words and text without spaces is a single word, but counts stay the
+    # same as they have always been
+    name = "compat"
+
+    def count(self, strings: list) -> int:
+        # what summing len(text.split(" ")) over the strings would give, in one pass
+        return "\n".join(strings).count(" ") + len(strings)
+
+    def string_counter(self, buffer_size: int) -> SplitCounter:
+        return SplitCounter()
+
+
+class TokenCounter():
+    # a Tokenizer's count of a string that arrives in pieces. Once buffer_size characters
+    # have piled up, everything before the last point no word can carry on past is counted
+    # and let go, so a huge paragraph doesn't have to be held in memory
+    def __init__(self, tokenizer: Tokenizer, buffer_size: int):
+        self.tokenizer = tokenizer
+        self.buffer_size = buffer_size
+        self.pieces = []
+        self.size = 0
+        self.counted = 0
+
+    def feed(self, text: str):
+        self.pieces.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            text = "".join(self.pieces)
+            boundary = self.tokenizer.boundary.search(text)
+            cut = boundary.end() if boundary else 0
+            self.counted += self.tokenizer.count_text(text[:cut])
+            self.pieces = [text[cut:]]
+            self.size = len(text) - cut
+
+    def words(self) -> int:
+        return self.counted + self.tokenizer.count_text("".join(self.pieces))
+
+
+TOKENIZERS = {
+    "compat": CompatTokenizer(),
+    "unicode": Tokenizer("unicode", [
+        ScriptRule("cjk", r"\p{Han}\p{Hiragana}\p{Katakana}\p{Bopomofo}"),
+        # these need a dictionary to find where words end, so without one a run is a word
+        ScriptRule("southeast_asian", r"\p{Thai}\p{Lao}\p{Khmer}\p{Myanmar}", per_character=False),
+    ]),
+}
+
+
+def get_tokenizer(options: Options):
+    if isinstance(options.tokenizer, str):
+        return TOKENIZERS[options.tokenizer]
+    return options.tokenizer
+
+
+class StreamingWordCounter(html.parser.HTMLParser):
+    # counts words the same way as the BeautifulSoup path, but from parser events
+    # rather than a tree: we only track which elements are open while the text goes by.
+    # BeautifulSoup's find_all(["h","p"]) returns nested matches too, so text inside
+    # a <p> inside another <p> is counted once for every counted element around it.
+    # Words are totalled separately from each of the anchors (element ids) we're given on.
+    COUNTED_TAGS = ("h", "p")
+    SKIPPED_TAGS = ("script", "style", "template", "rt", "rp")  # bs4 doesn't treat their text as strings
+    VOID_TAGS = ("area", "base", "basefont", "bgsound", "br", "col", "command", "embed",
+                 "frame", "hr", "image", "img", "input", "isindex", "keygen", "link",
+                 "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr")
+
+    def __init__(self, anchors=frozenset(), tokenizer=TOKENIZERS["compat"], buffer_size: int = 65536):
+        super().__init__(convert_charrefs=True)
+        self.anchors = anchors
+        self.tokenizer = tokenizer
+        self.buffer_size = buffer_size
+        self.fragment = ""  # the last anchor we passed
+        self.segments = {"": 0}
+        self.open_tags = []
+        self.closed_void_tags = []  # bs4 swallows the end tag after a void start tag like <img>
+        self.counted_depth = 0  # how many counted elements are open
+        self.skipped_depth = 0
+        self.string = None  # counter for the current string, which may arrive in several calls
+
+    def flush_text(self):
+        if self.string:
+            self.segments[self.fragment] += self.string.words() * self.counted_depth
+            self.string = None
+
+    def check_anchor(self, tag, attrs):
+        if self.anchors:
+            for name, value in attrs:
+                if (name == "id" or (name == "name" and tag == "a")) and value in self.anchors:
+                    self.fragment = value
+                    self.segments.setdefault(value, 0)
+                    return
+
+    def handle_starttag(self, tag, attrs):
+        self.flush_text()
+        self.check_anchor(tag, attrs)
+        if tag in self.VOID_TAGS:
+            self.closed_void_tags.append(tag)
+            return
+        self.open_tags.append(tag)
+        if tag in self.COUNTED_TAGS:
+            self.counted_depth += 1
+        elif tag in self.SKIPPED_TAGS:
+            self.skipped_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.flush_text()  # an empty element like <p/> holds no text
+        self.check_anchor(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in self.closed_void_tags:
+            self.closed_void_tags.remove(tag)
+            return
+        self.flush_text()
+        if tag not in self.open_tags:
+            return  # stray end tag, ignored just as bs4 does
+        # an end tag closes everything opened since its start tag
+        while self.open_tags:
+            closed = self.open_tags.pop()
+            if closed in self.COUNTED_TAGS:
+                self.counted_depth -= 1
+            elif closed in self.SKIPPED_TAGS:
+                self.skipped_depth -= 1
+            if closed == tag:
+                break
+
+    def handle_data(self, data):
+        # which elements are open can't change before the string ends, so only count what will be kept
+        if self.counted_depth and not self.skipped_depth:
+            if self.string is None:
+                self.string = self.tokenizer.string_counter(self.buffer_size)
+            self.string.feed(data)
+
+    # comments, declarations and processing instructions aren't counted, but do end the current string
+    def handle_comment(self, data):
+        self.flush_text()
+
+    def handle_decl(self, decl):
+        self.flush_text()
+
+    def handle_pi(self, data):
+        self.flush_text()
+
+    def unknown_decl(self, data):
+        self.flush_text()
+        if data.upper().startswith("CDATA["):
+            # bs4 keeps a CDATA section as a string of its own, and counts it even inside <script>
+            self.string = self.tokenizer.string_counter(self.buffer_size)
+            self.string.feed(data[len("CDATA["):])
+            self.flush_text()
+
+    def close(self):
+        super().close()
+        self.flush_text()
+
+
+def count_words_bs4(hf, anchors=frozenset(), buffer_size: int = None, tokenizer=TOKENIZERS["compat"]) -> dict:
+    # BeautifulSoup needs the whole document at once, so there's no buffer to size.
+    # It's only imported when first used, as it's slow to load and the stream parser doesn't need it
+    from bs4 import BeautifulSoup
+    html = hf.read()
+
+    # we use the "BeautifulSoup" package which is an easy way to parse a HTML file
+    soup = BeautifulSoup(html, "html.parser")
+    if anchors:
+        return count_segments_bs4(soup, anchors, tokenizer)
+    resultSet = soup.find_all(["h","p"])  # find all headings and paragraphs
+    # the strings are gathered up and counted all at once, rather than split one by one
+    strings = []
+    for result in resultSet:
+        strings.extend(result.stripped_strings)
+    return {"": tokenizer.count(strings)}
+
+
+def count_segments_bs4(soup, anchors, tokenizer=TOKENIZERS["compat"]) -> dict:
+    # one walk through the document in order, so we know which anchor each string comes after.
+    # A string counts once for every heading or paragraph around it, just as in find_all above
+    from bs4 import CData, NavigableString, Tag
+    strings = {"": []}
+    fragment = ""
+    for element in soup.descendants:
+        if isinstance(element, Tag):
+            anchor = element.get("id")
+            if anchor not in anchors and element.name == "a":
+                anchor = element.get("name")
+            if anchor in anchors:
+                fragment = anchor
+                strings.setdefault(fragment, [])
+        elif type(element) in (NavigableString, CData):
+            text = element.strip()
+            if text:
+                depth = sum(1 for parent in element.parents if parent.name in ("h", "p"))
+                strings[fragment].extend([text] * depth)
+    return {fragment: tokenizer.count(texts) for fragment, texts in strings.items()}
+
+
+def count_words_stream(hf, anchors=frozenset(), buffer_size: int = 65536, tokenizer=TOKENIZERS["compat"]) -> dict:
+    # the document is fed through in pieces of buffer_size characters straight from the
+    # zip (or file), so memory depends on the buffer rather than on the size of the document
+    counter = StreamingWordCounter(anchors, tokenizer, buffer_size)
+    for chunk in iter(lambda: hf.read(buffer_size), ""):
+        counter.feed(chunk)
+    counter.close()
+    return counter.segments
+
+
+WORD_COUNTERS = {
+    "bs4": count_words_bs4,
+    "stream": count_words_stream,
+}
+
+
+def cache_parser(options: Options) -> str:
+    # the part of the cache key that says how a file was counted
+    tokenizer = get_tokenizer(options)
+    parser = options.parser
+    if tokenizer.name != "compat":
+        parser += f"+{tokenizer.name}"  # compat counts are cached just as they were before tokenizers
+    return f"{parser}/{COUNTER_VERSION}"
+
+
+def count_words(book: Book, html_file, anchors=frozenset()) -> dict:
+    # returns the words in the file from its start and from each anchor found in it, in document order
+    segments = {"": 0}
+    if file_exists(book, html_file):
+        info = member_info(book, html_file)
+        tokenizer = get_tokenizer(book.options)
+        parser = cache_parser(book.options)
+        anchor_key = " ".join(sorted(anchors))
+        if book.cache and info:
+            cached = book.cache.lookup(info.CRC, info.file_size, parser, anchor_key)
+            if cached is not None:
+                return cached
+        with open_text(book, html_file) as hf:
+            segments = WORD_COUNTERS[book.options.parser](hf, anchors, book.options.buffer_size, tokenizer)
+        if book.cache and info:
+            book.cache.store(info.CRC, info.file_size, parser, anchor_key, segments)
+    return segments
+
+
+def count_spine(book: Book):
+    # the table of contents may point part way into a file, so each file is counted once,
+    # split at every anchor the table of contents points to within it
+    anchors = {}
+    for tocitem in book.tocitems:
+        if tocitem.fragment:
+            anchors.setdefault(tocitem.href, set()).add(tocitem.fragment)
+    for spineitem in book.spineitems:
+        spineitem.segments = count_words(book, spineitem.href, frozenset(anchors.get(spineitem.href, ())))
+        spineitem.word_count = sum(spineitem.segments.values())
+
+
+def local_name(tag: str) -> str:
+    # ElementTree spells a namespaced tag as {uri}name
+    return tag.rsplit("}", 1)[-1]
+
+
+def replace_html_entities(data: bytes) -> bytes:
+    # XML only knows five named entities, but package files made by HTML tools often use
+    # others, such as &eacute; in a title. They're swapped for character references
+    def reference(match):
+        name = match.group(1).decode("ascii") + ";"
+        if name in ("amp;", "lt;", "gt;", "quot;", "apos;") or name not in html.entities.html5:
+            return match.group(0)
+        return "".join(f"&#{ord(c)};" for c in html.entities.html5[name]).encode("ascii")
+    return regex.sub(rb"&([A-Za-z][A-Za-z0-9]*);", reference, data)
+
+
+def read_spine(book: Book, opffile:str):
+    book.spineitems = []
+    with open_binary(book, opffile) as opf:
+        data = opf.read()
+    try:
+        root = ET.fromstring(data)
+    except ET.ParseError:
+        try:
+            root = ET.fromstring(replace_html_entities(data))
+        except ET.ParseError as e:
+            # without a spine there's nothing to count, so this book can't be done
+            raise ET.ParseError(f"unable to read {book.path}: {opffile}: {e}") from e
 
-def get_content_opf_file() -> str:
-    opf_file = recursive_find(".opf", temp_unzip)  # might be called content.opf or package.opf or whatever.
+    manifest = None
+    spine = None
+    for child in root:
+        if local_name(child.tag) == "manifest":
+            manifest = child
+        elif local_name(child.tag) == "spine":
+            spine = child
+
+    # first, have to read the manifest, which has the correct URLs
+    # manifest is not in same order as the spine! Need it in spine order, so index it by id
+    head, _ = split_path(book, opffile)
+    manifest_hrefs = {}
+    if manifest is not None:
+        for item in manifest:
+            if local_name(item.tag) == "item" and item.get("id") and item.get("href"):
+                manifest_hrefs[item.get("id")] = item.get("href")
+                if "nav" in item.get("properties", "").split():
+                    book.toc_nav = join_path(book, head, href_to_filepath(book, item.get("href")))
+                elif item.get("media-type") == "application/x-dtbncx+xml" and not book.toc_ncx:
+                    book.toc_ncx = join_path(book, head, href_to_filepath(book, item.get("href")))
+
+    if spine is not None:
+        ncx_href = manifest_hrefs.get(spine.get("toc"))
+        if ncx_href:
+            book.toc_ncx = join_path(book, head, href_to_filepath(book, ncx_href))
+        for itemref in spine:
+            if local_name(itemref.tag) != "itemref":
+                continue
+            href = manifest_hrefs.get(itemref.get("idref"))
+            if not href:
+                continue  # spine entry with nothing in the manifest, nothing to count
+            spineitem = SpineItem()
+            spineitem.spine_id = itemref.get("idref")
+            spineitem.href, _ = resolve_href(book, head, href)
+            book.spineitems.append(spineitem)
+
+
+def get_content_opf_file(book: Book) -> str:
+    # META-INF/container.xml says where the package file is
+    container = join_path(book, book.temp_unzip, href_to_filepath(book, "META-INF/container.xml"))
+    if file_exists(book, container):
+        try:
+            with open_binary(book, container) as cf:
+                root = ET.parse(cf).getroot()
+            for element in root.iter():
+                if local_name(element.tag) == "rootfile" and element.get("full-path"):
+                    opf_file = join_path(book, book.temp_unzip, href_to_filepath(book, element.get("full-path")))
+                    if file_exists(book, opf_file):
+                        return opf_file
+        except ET.ParseError as e:
+            print(f"Error! unable to read {container}: {e}")
+    opf_file = member_path(book, book.index.find_extension(".opf"))  # might be called content.opf or package.opf or whatever.
     return opf_file
 
 
-def get_tocitem_for_spine(spineitem:SpineItem) -> TocItem:
-    tocitem: TocItem = None
-    for tocitem in tocitems:
-        if tocitem.href == spineitem.href:
-            return tocitem
-    return None
-
+def allocate_count_to_tocitems(book: Book):
+    # index the toc by file and anchor, the first entry wins if several point to the same place
+    toc_index = {}
+    toc_by_file = {}
+    for tocitem in book.tocitems:
+        toc_index.setdefault((tocitem.href, tocitem.fragment), tocitem)
+        toc_by_file.setdefault(tocitem.href, []).append(tocitem)
 
-def allocate_count_to_tocitems(bookname: str):
-    global tocitems, spineitems
     spineitem: SpineItem = None
     bookToC = TocItem()
-    bookToC.title = bookname
+    bookToC.title = book.name
     lastToC = bookToC
-    for spineitem in spineitems:
-        tocitem = get_tocitem_for_spine(spineitem)
-        if tocitem:
-            lastToC = tocitem
-        else:
-            tocitem = lastToC
-        tocitem.word_count += spineitem.word_count
-
-
-def output_results(bookname):
-    for tocitem in tocitems:
-        if make_csv:
-            collect_output(f'"{bookname}","{tocitem.title}", {tocitem.order}, {tocitem.word_count}')
-        else:
-            collect_output(f"{tocitem.title}: {tocitem.word_count} words")
+    for spineitem in book.spineitems:
+        # words before the first anchor in a file, then the words after each anchor
+        for fragment, words in spineitem.segments.items():
+            tocitem = toc_index.get((spineitem.href, fragment))
+            if not tocitem and not fragment:
+                # an entry pointing at an anchor we never found still starts at this file
+                for candidate in toc_by_file.get(spineitem.href, []):
+                    if candidate.fragment not in spineitem.segments:
+                        tocitem = candidate
+                        break
+            if tocitem:
+                lastToC = tocitem
+            else:
+                tocitem = lastToC
+            tocitem.word_count += words
 
 
-def process_epub(epub_folder: str, path_to_file:str, bookname: str):
-    global tocitems, spineitems
+def process_epub(epub_folder: str, book: Book, options: Options, archive: PrefetchedArchive = None):
+    if options.in_memory or archive is not None:
+        # read the members we need straight out of the epub (which is just a zip file)
+        with timed(book, "open"):
+            zip_ref = archive or zipfile.ZipFile(book.path, 'r')
+            book.index = ArchiveIndex(zip_ref.infolist())
+        book.archive = zip_ref
+        try:
+            process_contents(book)
+        finally:
+            book.archive = None
+            zip_ref.close()
+        return
 
     # we start by unpacking the epub (which is just a zip file)
-    create_unzip_folder(epub_folder)
-    with zipfile.ZipFile(path_to_file, 'r') as zip_ref:
-        zip_ref.extractall(temp_unzip)
-
-    tocitems = []
-    spineitems = []
-    print(f"Starting to process {bookname}")
-
-    opf_file = get_content_opf_file()  # may return None
-    if not opf_file:
-        print("unable to find content.opf")
-        exit(-1)
-    
-    read_spine(opf_file)  # this also counts words in each spine item
-
-    # now try to find toc in various ways
-    toc_path = recursive_find(".ncx", temp_unzip)
+    create_unzip_folder(epub_folder, book)
+    try:
+        with timed(book, "open"):
+            with zipfile.ZipFile(book.path, 'r') as zip_ref:
+                book.index = ArchiveIndex(zip_ref.infolist())
+                zip_ref.extractall(book.temp_unzip)
+            book.bytes_decompressed = sum(info.file_size for info in book.index.members.values())
+        process_contents(book)
+    finally:
+        remove_unzip_folder(book)
+
+
+def process_contents(book: Book):
+    book.tocitems = []
+    book.spineitems = []
+    if book.options.verbose:
+        print(f"Starting to process {book.name}")
+
+    with timed(book, "opf"):
+        opf_file = get_content_opf_file(book)  # may return None
+        if not opf_file:
+            raise FileNotFoundError(f"unable to find content.opf in {book.path}")
+        read_spine(book, opf_file)
+    with timed(book, "toc"):
+        read_toc(book)
+    with timed(book, "count"):
+        count_spine(book)
+    with timed(book, "allocate"):
+        allocate_count_to_tocitems(book)
+
+
+def read_toc(book: Book):
+    # now try to find toc in various ways, starting with the ones the manifest names
+    toc_path = book.toc_ncx
+    if not toc_path or not file_exists(book, toc_path):
+        toc_path = member_path(book, book.index.find_extension(".ncx"))
     if toc_path:
-        process_toc_ncx(toc_path)
-        allocate_count_to_tocitems(bookname)
+        process_toc_ncx(book, toc_path)
         return
 
-    toc_path = recursive_find("toc.html", temp_unzip)
+    toc_path = book.toc_nav
+    if not toc_path or not file_exists(book, toc_path):
+        toc_path = member_path(book, book.index.find_basename("toc.html"))
     if not toc_path:
-        toc_path = recursive_find("toc.xhtml", temp_unzip)
+        toc_path = member_path(book, book.index.find_basename("toc.xhtml"))
     if toc_path:
-        process_toc_html(toc_path)
-        allocate_count_to_tocitems(bookname)
+        process_toc_html(book, toc_path)
         return
 
     # this is desperation, no toc.ncx or toc.xhtml, so build tocitems based on spine only
     spineitem:SpineItem = None
-    for spineitem in spineitems:
+    for spineitem in book.spineitems:
         tocitem = TocItem()
         tocitem.title = regex.sub(r'[-_]',' ',spineitem.spine_id)
         tocitem.title = regex.sub(r'\.x?html','',tocitem.title)
         tocitem.href = spineitem.href
-        tocitems.append(tocitem)
-    allocate_count_to_tocitems(bookname)
+        book.tocitems.append(tocitem)
 
 
-def process_tocitems(filepath: str, bookname:str, read_title: bool = False):
-    head, _ = os.path.split(filepath)
+def process_tocitems(book: Book, options: Options, filepath: str, read_title: bool = False) -> list:
+    lines = []
     tocitem = TocItem()
-    for tocitem in tocitems:
+    for tocitem in book.tocitems:
         # get rid of any anchors in the src URL
         if "#" in tocitem.href:
             bits = tocitem.href.split("#")
@@ -305,13 +1201,14 @@ def process_tocitems(filepath: str, bookname:str, read_title: bool = False):
         if not tocitem.href.endswith("html"):
             continue  # only want to process content files
 
-        html_file = os.path.join(head, tocitem.href)
+        html_file = tocitem.href
         if os.path.exists(html_file):
             with open(html_file,"r", encoding="utf8") as hf:
                 html = hf.read()
                 hf.close()
 
-            # we use the "BeautifulSoup" package which is an easy way to parse a HTML file    
+            # we use the "BeautifulSoup" package which is an easy way to parse a HTML file
+            from bs4 import BeautifulSoup
             soup = BeautifulSoup(html, "html.parser")
             if read_title:
                 title_tag = soup.find("title")
@@ -326,70 +1223,409 @@ def process_tocitems(filepath: str, bookname:str, read_title: bool = False):
                     if text:
                         bits = text.split(" ")
                         total_words += len(bits)
-            tocitem.wordcount = total_words
+            tocitem.word_count = total_words
             tocitem.title = tocitem.title.strip()
-        if make_csv:
-            collect_output(f'"{bookname}","{tocitem.title}",{tocitem.wordcount}')
+        if options.make_csv:
+            lines.append(f'"{book.name}","{tocitem.title}",{tocitem.word_count}')
         else:
-            collect_output(f"{tocitem.title}: {tocitem.wordcount} words")
-        
-
-def create_unzip_folder(epub_folder: str):
-    global temp_unzip
-    temp_unzip = os.path.join(epub_folder,"unzipped")
-    if not os.path.exists(temp_unzip):
-        os.mkdir(temp_unzip)
-    else:
-        remove_unzip_folder()
-        os.mkdir(temp_unzip)
+            lines.append(f"{tocitem.title}: {tocitem.word_count} words")
+    return lines
 
 
-def remove_unzip_folder():
-    global temp_unzip
-    if os.path.exists(temp_unzip):
+def create_unzip_folder(epub_folder: str, book: Book):
+    # every book gets its own scratch folder so several can be unpacked at once
+    book.temp_unzip = tempfile.mkdtemp(prefix="unzipped-", dir=epub_folder)
+
+
+def remove_unzip_folder(book: Book):
+    if os.path.exists(book.temp_unzip):
         try:
-            shutil.rmtree(temp_unzip)
+            shutil.rmtree(book.temp_unzip)
         except OSError as e:
-            print("Error: %s : %s" % (temp_unzip, e.strerror))
+            print("Error: %s : %s" % (book.temp_unzip, e.strerror))
+
+
+def profile_path(options: Options, afile: str) -> str:
+    return os.path.join(options.profile_dir, afile + ".prof")
+
+
+def count_book(afile: str, epub_folder: str, options: Options, archive: PrefetchedArchive = None) -> Book:
+    # process a single epub, runs in a worker when --jobs > 1
+    _, tail = os.path.split(afile)
+    bookname = regex.sub(r'.epub','',tail)
+    book = Book(os.path.join(epub_folder, afile), bookname, options)
+    if options.cache_path:
+        book.cache = ResultCache(options.cache_path)
+    if options.fingerprint:
+        book.size, book.mtime, book.sha256 = file_fingerprint(book.path)
+    profiler = None
+    if options.profile_dir:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    per_book_peak = options.reset_peak_rss and reset_peak_rss()
+    start_peak = peak_rss()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        process_epub(epub_folder, book, options, archive)
+    finally:
+        book.wall_time = time.perf_counter() - wall
+        book.cpu_time = time.process_time() - cpu
+        peak = peak_rss()
+        # memory freed by earlier books often stays with the process, so the growth
+        # is what picks out a hungry book, rather than the peak itself
+        if per_book_peak:
+            book.peak_rss = peak
+            book.peak_rss_scope = "book"
+            book.rss_growth = peak - start_peak  # the reset brings the peak down to what is in use now
+        elif peak is not None and peak > start_peak:
+            # without a reset, the peak only tells us about this book if the book raised it
+            book.peak_rss = peak
+            book.peak_rss_scope = "process"
+            book.rss_growth = peak - start_peak
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path(options, afile))
+        if book.cache:
+            book.cache_hits = book.cache.hits
+            book.cache_misses = book.cache.misses
+            book.cache.close()
+            book.cache = None  # the book is sent back to the main process, which can't take a connection
+    return book
+
+
+def source_name(source) -> str:
+    # the file name of a path or an open file, bytes have none
+    path = source if isinstance(source, (str, os.PathLike)) else getattr(source, "name", "")
+    return os.path.basename(path) if isinstance(path, (str, os.PathLike)) else ""
+
+
+def count_epub(source, options: Options = None, name: str = None) -> BookResult:
+    # count one epub for a program that imports us rather than running us. source is a path,
+    # the epub's bytes or a binary file object; it's read straight from the zip, with nothing
+    # written to disk. All the state lives in the book, so any number of threads can call this
+    # at once. Raises FileNotFoundError for an epub without a content.opf and
+    # zipfile.BadZipFile for something that isn't an epub at all.
+    if options is None:
+        options = Options()
+        options.verbose = False
+        options.cache_path = ""
+    if name is None:
+        name = source_name(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    elif not hasattr(source, "read"):
+        source = os.fspath(source)
+    # a ZipFile leaves a file object it was given open, that's up to whoever gave it to us
+    archive = zipfile.ZipFile(source, 'r')
+    book = count_book(name, "", options, archive)
+    words = sum(spineitem.word_count for spineitem in book.spineitems)
+    return BookResult(book.name, tuple(book.tocitems), words)
+
+
+def count_many(sources, options: Options = None):
+    # count_epub for each of sources in turn, yielding every result as soon as the book
+    # is done. sources is only read as we go, so it can be a generator of uploads. A book
+    # that can't be counted gives a result with error set rather than stopping the rest.
+    for source in sources:
+        try:
+            yield count_epub(source, options)
+        except (OSError, ValueError, KeyError, RuntimeError, zipfile.BadZipFile, ET.ParseError) as e:
+            # ValueError takes in a chapter that won't decode, KeyError and RuntimeError
+            # members the zip names but can't give us, such as encrypted ones
+            yield BookResult(regex.sub(r'.epub', '', source_name(source)), error=str(e) or type(e).__name__)
+
+
+def parse_shard(value: str) -> tuple:
+    # "i/N" for the i'th of N shards, counting from 1
+    bits = value.split("/")
+    if len(bits) != 2 or not bits[0].isdigit() or not bits[1].isdigit() or not 1 <= int(bits[0]) <= int(bits[1]):
+        raise argparse.ArgumentTypeError(f"expected i/N with 1 <= i <= N, not {value!r}")
+    return int(bits[0]), int(bits[1])
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="epub_counter",
+                                     description="Count the words in each table of contents entry of a directory of epubs. "
+                                                 "Run 'epub_counter merge DIRECTORY' to combine the results of --shard runs.")
+    parser.add_argument("directory", help="a directory of the epubs we want to process")
+    parser.add_argument("-t", "-T", dest="text", action="store_true",
+                        help="output as simple text rather than CSV file")
+    parser.add_argument("-m", "--in-memory", action="store_true",
+                        help="read straight from each epub without unpacking it to disk")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of books to process in parallel (default 1, 0 means one per CPU)")
+    parser.add_argument("-p", "--parser", choices=sorted(WORD_COUNTERS), default="bs4",
+                        help="bs4 builds a BeautifulSoup tree, stream counts from parser events (default bs4)")
+    parser.add_argument("--tokenizer", choices=sorted(TOKENIZERS), default=Options.tokenizer,
+                        help="compat counts a word per space as ever, unicode finds words by script, "
+                             "counting each Chinese or Japanese character as a word (default compat)")
+    parser.add_argument("--buffer-size", type=int, default=Options.buffer_size,
+                        help=f"characters the stream parser reads at a time, which bounds its memory (default {Options.buffer_size})")
+    parser.add_argument("--no-cache", action="store_true",
+                        help=f"don't read or update the chapter word count cache ({CACHE_FILE} in DIRECTORY)")
+    parser.add_argument("--rebuild-cache", action="store_true",
+                        help="empty the chapter word count cache before counting")
+    parser.add_argument("--cache-size", type=int, default=Options.cache_size,
+                        help=f"most chapters to keep in the cache, least recently used go first (default {Options.cache_size})")
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on from an interrupted run, skipping books already in the output")
+    parser.add_argument("--stats-json", nargs="?", const="", metavar="PATH",
+                        help="write timings and sizes for every book as JSON (default PATH is stats.json in DIRECTORY)")
+    parser.add_argument("--profile", type=int, default=0, metavar="N",
+                        help="profile every book and keep cProfile data for the N slowest in DIRECTORY/profiles")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="N",
+                        help="read and decompress up to N books ahead in background threads while counting, "
+                             "memory grows with N (implies --in-memory, not with --jobs)")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="count only the i'th of N shards of the epubs, chosen by a hash of the file names, "
+                             "into DIRECTORY/results.shard-i-of-N.jsonl, for merge to combine (-t is left to merge)")
+    args = parser.parse_args(argv)
+    if args.prefetch > 0 and args.jobs != 1:
+        parser.error("--prefetch can't be combined with --jobs, the worker processes already overlap reading and counting")
+    return args
+
+
+def parse_merge_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="epub_counter merge",
+                                     description="Combine the results of --shard runs into the results a single run would write.")
+    parser.add_argument("directory", help="the directory of epubs the shards were run on")
+    parser.add_argument("-t", "-T", dest="text", action="store_true",
+                        help="output as simple text rather than CSV file")
+    parser.add_argument("--shards", type=int, metavar="N",
+                        help="merge the results of the N shard run, needed when the directory holds "
+                             "results for more than one number of shards")
+    return parser.parse_args(argv)
+
+
+def find_shard_files(epub_folder: str, shards: int) -> tuple:
+    # the result files of the one run of N shards in shard order, the i's of that run
+    # with no file, and the files of runs with some other N
+    found = {}  # N -> {i: shard file}
+    for afile in os.listdir(epub_folder):
+        match = regex.fullmatch(r"results\.shard-(\d+)-of-(\d+)\.jsonl", afile)
+        if match:
+            found.setdefault(int(match.group(2)), {})[int(match.group(1))] = afile
+    if shards is None:
+        if len(found) > 1:
+            counts = ", ".join(str(count) for count in sorted(found))
+            print(f"ERROR: {epub_folder} holds results for {counts} shards, pass --shards N to say which run to merge")
+            exit(-1)
+        shards = next(iter(found), None)
+    run = found.pop(shards, {})
+    others = sorted(afile for files in found.values() for afile in files.values())
+    shard_files = [run[index] for index in sorted(run)]
+    absent = [index for index in range(1, (shards or 0) + 1) if index not in run]
+    return shard_files, absent, others
+
+
+def read_shard_results(epub_folder: str, shard_files: list) -> tuple:
+    # every book in the shard result files, the first of each if a book was counted twice,
+    # (epub file, shard files, whether they agree) for the books that were, and
+    # how the books were counted -> the shard files counted that way
+    books = {}  # epub file -> (shard file, entry)
+    duplicates = []
+    settings = {}
+    for shard_file in shard_files:
+        with open(os.path.join(epub_folder, shard_file), "r", encoding="utf-8") as infile:
+            for line in infile:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Error! {shard_file} ends with a book cut short, run that shard again with --resume")
+                    break
+                counted = (entry.get("parser"), entry.get("tokenizer"), entry.get("counter"))
+                settings.setdefault(counted, set()).add(shard_file)
+                if entry["file"] in books:
+                    first_file, first = books[entry["file"]]
+                    agrees = first["sha256"] == entry["sha256"] and first["entries"] == entry["entries"]
+                    duplicates.append((entry["file"], first_file, shard_file, agrees))
+                else:
+                    books[entry["file"]] = (shard_file, entry)
+    return books, duplicates, settings
+
+
+def merge_shards(argv: list) -> None:
+    args = parse_merge_args(argv)
+    epub_folder = args.directory
+    if not os.path.exists(epub_folder):
+        print("ERROR: No such directory!")
+        exit(-1)
+    shard_files, absent, others = find_shard_files(epub_folder, args.shards)
+    if not shard_files:
+        print(f"ERROR: no shard results (results.shard-i-of-N.jsonl) in {epub_folder}")
+        exit(-1)
+    books, duplicates, settings = read_shard_results(epub_folder, shard_files)
+    if len(settings) > 1:
+        # counts from different parsers or tokenizers don't add up to what a single run would write
+        print("ERROR: the shards weren't all counted the same way, nothing merged")
+        for (parser, tokenizer, counter), files in sorted(settings.items(), key=str):
+            print(f"  parser {parser}, tokenizer {tokenizer}, counter version {counter}: {', '.join(sorted(files))}")
+        exit(-1)
+    options = Options()
+    options.make_csv = not args.text
+    fpath = os.path.join(epub_folder, "results.csv" if options.make_csv else "results.txt")
+    writer = ResultsWriter(fpath, options)
+    # the same files in the same order as a single run in this directory would count them
+    epub_files = [afile for afile in os.listdir(epub_folder) if afile.endswith(".epub")]
+    missing = []
+    changed = []
+    for afile in epub_files:
+        if afile not in books:
+            missing.append(afile)
+            continue
+        _, entry = books[afile]
+        path = os.path.join(epub_folder, afile)
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime) != (entry["size"], entry["mtime"]) and file_fingerprint(path)[2] != entry["sha256"]:
+            changed.append(afile)
+        book = Book(path, entry["name"], options)
+        for title, order, level, word_count in entry["entries"]:
+            tocitem = TocItem()
+            tocitem.title = title
+            tocitem.order = order
+            tocitem.level = level
+            tocitem.word_count = word_count
+            book.tocitems.append(tocitem)
+        writer.write_book(afile, book)
+    writer.close()
+    gone = sorted(set(books) - set(epub_files))
+
+    print(f"Merged {len(epub_files) - len(missing)} books from {len(shard_files)} shard files into {fpath}")
+    shards = len(shard_files) + len(absent)
+    for index in absent:
+        print(f"Missing: results{shard_suffix((index, shards))}.jsonl, that shard hasn't been run")
+    for afile in others:
+        print(f"Ignored: {afile} is from a run with a different number of shards")
+    for afile in sorted(missing):
+        print(f"Missing: {afile} isn't in any shard's results")
+    for afile, first_file, shard_file, agrees in duplicates:
+        print(f"Duplicate: {afile} is in {first_file} and {shard_file}{'' if agrees else ' with different counts'}, "
+              f"using {first_file}")
+    for afile in changed:
+        print(f"Changed: {afile} has changed since its shard counted it")
+    for afile in gone:
+        print(f"Gone: {afile} was counted but is no longer in the directory, left out")
+    if missing or changed or absent or not all(agrees for _, _, _, agrees in duplicates):
+        exit(-1)
 
 
 def main() -> None:
-    global make_csv
-
+    if sys.argv[1:2] == ["merge"]:
+        merge_shards(sys.argv[2:])
+        return
     # directory of epub files must be passed as first argument on command line
-    if len(sys.argv) < 2:
-        print("""USAGE: epub_counter DIRECTORY [-t]
-        where DIRECTORY is a directory of the epubs we want to process
-        and -t optional output as simple text rather than CSV file""")
-        exit(0)
-
-    epub_folder = sys.argv[1]
-
-    # check to see if CSV output is wanted and if so, set flag
-    if len(sys.argv) > 2:
-        if sys.argv[2].lower() == "-t":
-            make_csv = False
-    
-    # write field names for CSV at top of output file
-    if make_csv:
-        collect_output(f'"Book","Title","Order","Words"')
+    args = parse_args(sys.argv[1:])
+    epub_folder = args.directory
+    options = Options()
+    options.make_csv = not args.text
+    options.in_memory = args.in_memory
+    options.jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    options.parser = args.parser
+    options.tokenizer = args.tokenizer
+    options.buffer_size = max(args.buffer_size, 1)
+    options.prefetch = max(args.prefetch, 0)
+    # shards share the directory, so each gets files of its own. SQLite can't be shared safely
+    # over a network filesystem, but a shard counts the same books every time it is run anyway
+    suffix = shard_suffix(args.shard) if args.shard else ""
+    if not args.no_cache:
+        cache_file, cache_extension = os.path.splitext(CACHE_FILE)
+        options.cache_path = os.path.join(epub_folder, cache_file + suffix + cache_extension)
+    options.cache_size = args.cache_size
+    options.fingerprint = bool(args.shard)
+    options.reset_peak_rss = True
 
     if os.path.exists(epub_folder):
+        if args.shard:
+            writer = ShardWriter(os.path.join(epub_folder, f"results{suffix}.jsonl"), options, args.resume)
+        elif options.make_csv:
+            writer = ResultsWriter(os.path.join(epub_folder,"results.csv"), options, args.resume)
+        else:
+            writer = ResultsWriter(os.path.join(epub_folder,"results.txt"), options, args.resume)
+        if writer.done:
+            print(f"Resuming, {len(writer.done)} books already done")
         # cycle through each file in the folder and process if it's an epub.
-        for afile in os.listdir(epub_folder):
-            if afile.endswith(".epub"):
-                _, tail = os.path.split(afile)
-                bookname = regex.sub(r'.epub','',tail)
-                if not make_csv:
-                    collect_output(f"\n\nprocessing {afile}")
-                path = os.path.join(epub_folder, afile)
-                process_epub(epub_folder, path, bookname)
-                output_results(bookname)
-        if make_csv:
-            write_output(os.path.join(epub_folder,"results.csv"))
+        epub_files = [afile for afile in os.listdir(epub_folder)
+                      if afile.endswith(".epub") and afile not in writer.done]
+        if args.shard:
+            index, shards = args.shard
+            epub_files = [afile for afile in epub_files if shard_of(afile, shards) == index]
+        if options.cache_path and args.rebuild_cache:
+            cache = ResultCache(options.cache_path)
+            cache.clear()
+            cache.close()
+        stats = None
+        if args.stats_json is not None:
+            stats = StatsWriter(args.stats_json or os.path.join(epub_folder, f"stats{suffix}.json"))
+        if args.profile > 0:
+            options.profile_dir = os.path.join(epub_folder, "profiles")
+            os.makedirs(options.profile_dir, exist_ok=True)
+        profiled = []  # heap of (wall time, epub file) of the slowest books, whose profiles we keep
+        worker = functools.partial(count_book, epub_folder=epub_folder, options=options)
+        cache_hits = 0
+        cache_misses = 0
+        output_time = 0.0
+        run_peak_rss = 0  # books counted in this process reset its peak, so the run's is kept here
+        start = time.perf_counter()
+        pool = None
+        if options.jobs > 1:
+            pool = multiprocessing.Pool(options.jobs)
+            # imap hands results back in submission order, so output matches a serial run
+            books = pool.imap(worker, epub_files)
+        elif options.prefetch:
+            books = (worker(afile, archive=archive)
+                     for afile, archive in prefetch_archives(epub_folder, epub_files, options.prefetch, options))
         else:
-            write_output(os.path.join(epub_folder,"results.txt"))            
-        remove_unzip_folder()
+            books = map(worker, epub_files)
+        try:
+            for afile, book in zip(epub_files, books):
+                output_start = time.perf_counter()
+                writer.write_book(afile, book)
+                output_time += time.perf_counter() - output_start
+                cache_hits += book.cache_hits
+                cache_misses += book.cache_misses
+                if options.jobs == 1 and book.peak_rss:
+                    run_peak_rss = max(run_peak_rss, book.peak_rss)
+                if stats:
+                    stats.write_book(afile, book)
+                if options.profile_dir:
+                    heapq.heappush(profiled, (book.wall_time, afile))
+                    if len(profiled) > args.profile:
+                        _, fastest = heapq.heappop(profiled)
+                        os.remove(profile_path(options, fastest))
+        except (FileNotFoundError, ET.ParseError) as e:
+            writer.close(finished=False)
+            print(e)
+            exit(-1)
+        finally:
+            if pool:
+                pool.terminate()
+        writer.close()
+        evicted = 0
+        if options.cache_path:
+            cache = ResultCache(options.cache_path)
+            evicted = cache.evict(options.cache_size)
+            cache.close()
+            print(f"Cache: {cache_hits} hits, {cache_misses} misses, {evicted} evicted")
+        slowest = [{"file": afile, "wall_time": wall, "profile": profile_path(options, afile)}
+                   for wall, afile in sorted(profiled, reverse=True)]
+        if slowest:
+            print(f"Profiles of the {len(slowest)} slowest books are in {options.profile_dir}")
+        if stats:
+            stats.close({
+                "books": stats.count,
+                "wall_time": time.perf_counter() - start,
+                "output_time": output_time,
+                "jobs": options.jobs,
+                "parser": options.parser,
+                "tokenizer": options.tokenizer,
+                "in_memory": options.in_memory,
+                "cache_hits": cache_hits,
+                "cache_misses": cache_misses,
+                "cache_evicted": evicted,
+                "peak_rss": max(run_peak_rss, peak_rss() or 0) or None,  # of the main process, each book has its worker's
+                "slowest": slowest,
+            })
     else:
         print("ERROR: No such directory!")
         exit(-1)
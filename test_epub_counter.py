@@ -0,0 +1,272 @@
+import io
+import os
+import random
+import subprocess
+import sys
+import zipfile
+
+import pytest
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import benchmark
+import epub_counter
+
+# (fragment, words) where the stream engine has to agree with BeautifulSoup's find_all(["h","p"])
+CONFORMANCE = [
+    # a string counts once for every <p> or <h> around it
+    ('<p>a b<p>c d</p> e</p>', 7),
+    ('<p>one <p>two <p>three</p></p></p>', 6),
+    ('<h>x <p>y</p></h>', 3),
+    # text bs4 doesn't keep as strings
+    ('<p>a<script>var x = "<p>no</p>";</script>b</p>', 2),
+    ('<p>a<style>p { }</style>b</p>', 2),
+    ('<p><ruby>漢<rp>(</rp><rt>kan</rt><rp>)</rp></ruby> z</p>', 2),
+    ('<template><p>t t</p></template><p>k</p>', 1),
+    # CDATA is a string of its own, but never counted outside <p> and <h>
+    ('<p>x<![CDATA[y z]]>w</p>', 4),
+    ('<script><![CDATA[c d]]></script><p>k</p>', 1),
+    # comments end a string
+    ('<p>ab<!--c-->cd</p>', 2),
+    # stray end tags are ignored, and the end tag after a void element is swallowed
+    ('</p></h><p>x y</p></div>', 2),
+    ('<p>a<img src=x>b</img>c</p>', 2),
+    ('<p>a<br>b<br/>c</p>', 3),
+    # runs of spaces count empty words, as split(" ") always has
+    ('<p>  spaced   out  </p>', 4),
+    ('<h1>not counted</h1><h>counted</h>', 1),
+]
+
+FRAGMENT_PIECES = [
+    '<img src=x>', '</img>', '<br/>', '</br>', '<![CDATA[c d]]>', '<?pi?>', '<template>', '</template>',
+    '<rt>', '</rt>', '<ruby>', '<P>', '<H>', '&nbsp;', '\xa0 ', '<style>a b</style>', '<p>', '</p>', '<h>',
+    '</h>', '<div>', '</div>', '<b>', '</b>', ' ', 'word', 'two words', '\n', '<br>', '<!--c-->',
+    '<script>x y</script>', '&amp;', '<p/>', '<span id="a">', '</span>', '<p id="b">', '<a name="c">',
+]
+
+
+def count(engine, html: str, anchors=frozenset(), buffer_size: int = 3) -> dict:
+    return engine(io.StringIO(html), anchors, buffer_size)
+
+
+@pytest.mark.parametrize("html, words", CONFORMANCE)
+def test_stream_matches_bs4(html, words):
+    assert count(epub_counter.count_words_bs4, html) == {"": words}
+    assert count(epub_counter.count_words_stream, html) == {"": words}
+
+
+def test_segments_match_bs4():
+    html = '<p>a b <span id="s1">c</span> d<p id="s2">e f</p></p>'
+    anchors = frozenset({"s1", "s2"})
+    expected = {"": 2, "s1": 2, "s2": 4}
+    assert count(epub_counter.count_words_bs4, html, anchors) == expected
+    assert count(epub_counter.count_words_stream, html, anchors) == expected
+
+
+@pytest.mark.parametrize("buffer_size", [1, 3, 65536])
+def test_stream_matches_bs4_on_random_fragments(buffer_size):
+    rnd = random.Random(buffer_size)
+    for _ in range(1000):
+        html = "".join(rnd.choice(FRAGMENT_PIECES) for _ in range(rnd.randint(1, 40)))
+        for anchors in (frozenset(), frozenset({"a", "b", "c"})):
+            expected = count(epub_counter.count_words_bs4, html, anchors)
+            assert count(epub_counter.count_words_stream, html, anchors, buffer_size) == expected, html
+
+
+
+def toc_counts(result) -> list:
+    return [(entry.title, entry.level, entry.order, entry.word_count) for entry in result.entries]
+
+
+def count_with(epub_path, parser: str, tokenizer: str = "compat") -> list:
+    options = epub_counter.Options()
+    options.verbose = False
+    options.parser = parser
+    options.tokenizer = tokenizer
+    return toc_counts(epub_counter.count_epub(str(epub_path), options))
+
+
+@pytest.mark.parametrize("toc", ["ncx", "nav", "none"])
+@pytest.mark.parametrize("sections", [0, 3])
+def test_stream_matches_bs4_on_whole_books(tmp_path, toc, sections):
+    # through the zip, the spine, the toc and allocation to its entries, nested ones included
+    epub_path = tmp_path / "book.epub"
+    benchmark.make_epub(str(epub_path), chapters=4, chapter_words=300, toc=toc, sections=sections, seed=sections)
+    expected = count_with(epub_path, "bs4")
+    assert sum(words for _, _, _, words in expected) > 0
+    if toc != "none" and sections:
+        assert any(level == 2 and words for _, level, _, words in expected)
+    assert count_with(epub_path, "stream") == expected
+    assert count_with(epub_path, "stream", "unicode") == count_with(epub_path, "bs4", "unicode")
+
+
+@pytest.mark.parametrize("parser", ["bs4", "stream"])
+def test_unpacked_book_matches_zip(tmp_path, parser):
+    # the default command line path unpacks the epub to disk rather than reading the zip
+    benchmark.make_epub(str(tmp_path / "book.epub"), chapters=3, chapter_words=200, toc="nav", sections=2)
+    options = epub_counter.Options()
+    options.verbose = False
+    options.parser = parser
+    book = epub_counter.count_book("book.epub", str(tmp_path), options)
+    assert toc_counts(epub_counter.BookResult(book.name, tuple(book.tocitems))) == \
+        count_with(tmp_path / "book.epub", parser)
+
+
+
+def epub_with_opf(opf: str, chapters: int = 2) -> bytes:
+    # a book of chapters of 100 words each, under the package file given
+    epub = io.BytesIO()
+    with zipfile.ZipFile(epub, "w") as zf:
+        zf.writestr("META-INF/container.xml", benchmark.CONTAINER)
+        zf.writestr("OEBPS/content.opf", opf)
+        for n in range(1, chapters + 1):
+            zf.writestr(f"OEBPS/text/chapter{n}.xhtml", benchmark.make_chapter(random.Random(n), n, 100, 0))
+    return epub.getvalue()
+
+
+def test_opf_with_html_entities():
+    opf = benchmark.make_opf(2, 2, "none").replace("<dc:title>Synthetic</dc:title>",
+                                                   "<dc:title>Caf&eacute; &amp; &hellip;</dc:title>")
+    result = epub_counter.count_epub(epub_with_opf(opf))
+    assert [entry.word_count for entry in result.entries] == [100, 100]
+
+
+def test_unreadable_opf_is_an_error():
+    opf = benchmark.make_opf(2, 2, "none").replace("</manifest>", "")
+    with pytest.raises(epub_counter.ET.ParseError):
+        epub_counter.count_epub(epub_with_opf(opf))
+    good = epub_with_opf(benchmark.make_opf(2, 2, "none"))
+    results = list(epub_counter.count_many([epub_with_opf(opf), good]))
+    assert results[0].error and results[1].words == 200
+
+
+
+@pytest.mark.skipif(resource is None, reason="peak memory isn't reported on this platform")
+def test_library_leaves_the_peak_memory_alone():
+    # the host process's own high-water mark must survive counting a book
+    ballast = bytearray(64 * 1024 * 1024)
+    ballast[::4096] = b"1" * len(ballast[::4096])
+    del ballast
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    epub_counter.count_epub(epub_with_opf(benchmark.make_opf(2, 2, "none")))
+    assert resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >= before
+
+
+
+def test_prefetch_decompresses_only_uncached_spine_members(tmp_path, monkeypatch):
+    epub_path = tmp_path / "book.epub"
+    benchmark.make_epub(str(epub_path), chapters=3, chapter_words=100, toc="ncx")
+    options = epub_counter.Options()
+    options.verbose = False
+    chapters = {f"OEBPS/text/chapter{n}.xhtml" for n in (1, 2, 3)}
+    # the toc, the opf and container.xml are read when the book is counted, not ahead
+    assert set(epub_counter.PrefetchedArchive(str(epub_path), options).contents) == chapters
+
+    # a member too big to hold is streamed instead
+    with zipfile.ZipFile(epub_path) as epub:
+        size = epub.getinfo("OEBPS/text/chapter2.xhtml").file_size
+    monkeypatch.setattr(epub_counter.PrefetchedArchive, "LARGEST_MEMBER", size - 1)
+    assert set(epub_counter.PrefetchedArchive(str(epub_path), options).contents) < chapters
+    monkeypatch.undo()
+
+    # once the book is in the cache, nothing needs decompressing ahead
+    options.cache_path = str(tmp_path / "cache.sqlite")
+    epub_counter.count_epub(str(epub_path), options)
+    archive = epub_counter.PrefetchedArchive(str(epub_path), options)
+    assert archive.contents == {}
+    book = epub_counter.count_book("book.epub", str(tmp_path), options, archive)
+    assert book.cache_hits == 3 and book.cache_misses == 0
+
+
+
+def run_counter(*args) -> subprocess.CompletedProcess:
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.run([sys.executable, os.path.join(here, "epub_counter.py"), *map(str, args)],
+                          capture_output=True, text=True)
+
+
+def test_merged_shards_match_a_single_run(tmp_path):
+    for n in range(6):
+        benchmark.make_epub(str(tmp_path / f"book{n}.epub"), chapters=2, chapter_words=100 + n,
+                            toc=("ncx", "nav", "none")[n % 3], sections=n % 2, seed=n)
+    assert run_counter(tmp_path, "--no-cache").returncode == 0
+    single = (tmp_path / "results.csv").read_text(encoding="utf-8")
+
+    for index in (1, 2):
+        assert run_counter(tmp_path, "--shard", f"{index}/2").returncode == 0
+    assert run_counter("merge", tmp_path).returncode == 0
+    assert (tmp_path / "results.csv").read_text(encoding="utf-8") == single
+
+    # results left from a run with another number of shards aren't mixed in
+    assert run_counter(tmp_path, "--shard", "1/1").returncode == 0
+    merge = run_counter("merge", tmp_path)
+    assert merge.returncode != 0 and "--shards" in merge.stdout
+    merge = run_counter("merge", tmp_path, "--shards", "2")
+    assert merge.returncode == 0 and "Ignored: results.shard-1-of-1.jsonl" in merge.stdout
+    assert (tmp_path / "results.csv").read_text(encoding="utf-8") == single
+    os.remove(tmp_path / "results.shard-1-of-1.jsonl")
+
+    # a shard that hasn't been run is missing
+    os.rename(tmp_path / "results.shard-2-of-2.jsonl", tmp_path / "shard2")
+    merge = run_counter("merge", tmp_path)
+    assert merge.returncode != 0 and "Missing: results.shard-2-of-2.jsonl" in merge.stdout
+
+    # nor are shards counted with different settings
+    assert run_counter(tmp_path, "--shard", "2/2", "--tokenizer", "unicode").returncode == 0
+    merge = run_counter("merge", tmp_path)
+    assert merge.returncode != 0 and "weren't all counted the same way" in merge.stdout
+
+
+BIG_CHAPTER_BYTES = 500 * 1024 * 1024
+BIG_CHAPTER_PEAK_RSS = 100 * 1024 * 1024
+
+# counts the epub in a process of its own, so the peak is this book's alone
+MEASURE_PEAK = """
+import resource, sys
+import epub_counter
+options = epub_counter.Options()
+options.verbose = False
+options.parser = "stream"
+result = epub_counter.count_epub(sys.argv[1], options)
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(result.words, peak if sys.platform == "darwin" else peak * 1024)
+"""
+
+
+def write_big_epub(path, chapter_bytes: int) -> int:
+    # streams a chapter of about chapter_bytes into the zip, half of it one enormous paragraph,
+    # without ever holding it in memory. Returns the words in it
+    paragraph = "<p>" + " ".join(benchmark.WORDS[:20]) + "</p>\n"
+    words = 0
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as epub:
+        epub.writestr("META-INF/container.xml", benchmark.CONTAINER)
+        epub.writestr("OEBPS/content.opf", benchmark.make_opf(1, 1, "none"))
+        with epub.open("OEBPS/text/chapter1.xhtml", "w", force_zip64=True) as chapter:
+            chapter.write(b"<html><body>\n")
+            block = (paragraph * 1000).encode("utf-8")
+            for _ in range(chapter_bytes // 2 // len(block)):
+                chapter.write(block)
+                words += 20 * 1000
+            chapter.write(b"<p>")
+            block = (" ".join(benchmark.WORDS[:20]) + " ").encode("utf-8") * 1000
+            for _ in range(chapter_bytes // 2 // len(block)):
+                chapter.write(block)
+                words += 20 * 1000
+            chapter.write(b"end</p>\n</body></html>\n")
+            words += 1
+    return words
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(resource is None, reason="peak memory isn't reported on this platform")
+def test_stream_memory_is_bounded_on_a_huge_chapter(tmp_path):
+    epub_path = tmp_path / "big.epub"
+    words = write_big_epub(epub_path, BIG_CHAPTER_BYTES)
+    here = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run([sys.executable, "-c", MEASURE_PEAK, str(epub_path)], cwd=here,
+                            capture_output=True, text=True, check=True)
+    counted, peak = map(int, result.stdout.split())
+    assert counted == words
+    assert peak < BIG_CHAPTER_PEAK_RSS